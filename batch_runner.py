@@ -0,0 +1,372 @@
+"""Run a JSONL file of mech requests through the local tools"""
+
+import argparse
+import functools
+import importlib
+import json
+import os
+import statistics
+import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import yaml
+from dotenv import load_dotenv
+
+REPO_ROOT = Path(__file__).parent
+ORDER_SUBMITTED = "submitted"
+ORDER_COMPLETED = "completed"
+ID_KEYS = ("request_id", "id")
+DEFAULT_DEDUP_CACHE_SIZE = 10000
+
+
+@functools.lru_cache(maxsize=None)
+def get_tool_callables() -> Dict[str, Tuple[str, str]]:
+    """Map every tool name to its entry point module and callable"""
+
+    tools = {}
+    for root, dirs, files in os.walk(REPO_ROOT / "packages"):
+        if "component.yaml" not in files:
+            continue
+
+        with open(os.path.join(root, "component.yaml"), "r", encoding="utf-8") as file:
+            config = yaml.safe_load(file)
+
+        script_path = os.path.join(root, config["entry_point"])
+        module_name = os.path.splitext(os.path.relpath(script_path, REPO_ROOT))[
+            0
+        ].replace(os.sep, ".")
+        tools[config["name"]] = (module_name, config["callable"])
+
+    return tools
+
+
+class ErrorResponse(tuple):
+    """A mech response built by the error_response of a tool"""
+
+
+def flag_errors(error_response):
+    """Mark the responses built by the error_response of a tool"""
+
+    @functools.wraps(error_response)
+    def wrapper(*args, **kwargs):
+        return ErrorResponse(error_response(*args, **kwargs))
+
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def get_tool(tool_name: str):
+    """Import the callable of a tool (once per worker)"""
+    module_name, callable_name = get_tool_callables()[tool_name]
+    module = importlib.import_module(module_name)
+
+    # Tools report their own failures through error_response, not exceptions
+    error_response = getattr(module, "error_response", None)
+    if error_response is not None and not hasattr(error_response, "__wrapped__"):
+        module.error_response = flag_errors(error_response)
+
+    return getattr(module, callable_name)
+
+
+def get_api_keys() -> Dict[str, Any]:
+    """Build the api keys from the environment"""
+    return {
+        "gemini": os.getenv("GEMINI_API_KEY"),
+        "RPCS": {"base": os.getenv("RPC_BASE")},
+        "twitter": os.getenv("TWITTER_CREDENTIALS"),
+    }
+
+
+def execute_request(tool_name: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Run a single request. Executed on the workers."""
+    start = time.perf_counter()
+    try:
+        response = get_tool(tool_name)(**kwargs)
+        if isinstance(response, ErrorResponse):
+            result, extras, error = None, list(response[1:]), response[0]
+        else:
+            result, extras, error = response[0], list(response[1:]), None
+    except Exception as e:
+        result, extras, error = None, None, f"{type(e).__name__}: {e}"
+    return {
+        "result": result,
+        "extras": extras,
+        "error": error,
+        "latency": time.perf_counter() - start,
+    }
+
+
+def error_result(error: str) -> Dict[str, Any]:
+    """Result of a request that could not be run"""
+    return {"result": None, "extras": None, "error": error, "latency": 0}
+
+
+def get_response(future: Future) -> Dict[str, Any]:
+    """Result of a request, including the failures of the executor itself"""
+    try:
+        return future.result()
+    except Exception as e:
+        # e.g. a worker process died (BrokenProcessPool) or a pickling error
+        return error_result(f"{type(e).__name__}: {e}")
+
+
+def read_requests(path: str) -> Iterator[Tuple[int, str]]:
+    """Stream the (non-empty) lines of a JSONL file"""
+    with open(path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if line:
+                yield line_number, line
+
+
+class BatchRunner:
+    """Dispatch mech requests to a worker pool and write their results"""
+
+    def __init__(
+        self,
+        executor,
+        output,
+        order: str = ORDER_SUBMITTED,
+        max_pending: int = 64,
+        deduplicate: bool = True,
+        api_keys: Optional[Dict[str, Any]] = None,
+        dedup_cache_size: int = DEFAULT_DEDUP_CACHE_SIZE,
+    ):
+        self.executor = executor
+        self.output = output
+        self.order = order
+        self.max_pending = max_pending
+        self.deduplicate = deduplicate
+        self.api_keys = api_keys or {}
+        self.dedup_cache_size = dedup_cache_size
+
+        # Requests waiting to be written, in submission order
+        self.pending: deque = deque()
+        # Futures of the latest executed requests, by request key (LRU)
+        self.futures: OrderedDict[str, Future] = OrderedDict()
+        self.running: set = set()
+
+        self.latencies = []
+        self.total = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    def submit(self, line_number: int, line: str):
+        """Submit a request, reusing the result of an identical one"""
+        self.total += 1
+
+        # Results that were not written yet count towards the limit too,
+        # so a slow request cannot make the queue behind it grow unbounded
+        while len(self.pending) >= self.max_pending and self.running:
+            self.wait_for_any()
+
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("the request is not a JSON object")
+        except ValueError as e:
+            self.add_error(
+                line_number, None, f"Invalid request on line {line_number}: {e}"
+            )
+            return
+
+        request_id = next(
+            (request.pop(key) for key in ID_KEYS if key in request), line_number
+        )
+        tool_name = request.pop("tool", None)
+
+        if tool_name not in get_tool_callables():
+            self.add_error(request_id, tool_name, f"Unknown tool: {tool_name}")
+            return
+
+        kwargs = {"api_keys": self.api_keys} | request
+        key = json.dumps([tool_name, kwargs], sort_keys=True, default=str)
+
+        future = self.futures.get(key) if self.deduplicate else None
+        duplicate = future is not None
+
+        if duplicate:
+            self.duplicates += 1
+            self.futures.move_to_end(key)
+        else:
+            try:
+                future = self.executor.submit(execute_request, tool_name, kwargs)
+            except Exception as e:
+                # A broken process pool rejects every new request
+                self.add_error(request_id, tool_name, f"{type(e).__name__}: {e}")
+                return
+            self.running.add(future)
+            if self.deduplicate:
+                self.futures[key] = future
+                while len(self.futures) > self.dedup_cache_size:
+                    self.futures.popitem(last=False)
+
+        self.pending.append((request_id, tool_name, future, duplicate))
+        self.flush()
+
+    def add_error(self, request_id: Any, tool_name: Optional[str], error: str):
+        """Queue an error result for a request that could not be run"""
+        future = Future()
+        future.set_result(error_result(error))
+        self.pending.append((request_id, tool_name, future, False))
+        self.flush()
+
+    def wait_for_any(self):
+        """Wait until at least one running request finishes"""
+        done, self.running = wait(self.running, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                self.latencies.append(future.result()["latency"])
+        self.flush()
+
+    def flush(self):
+        """Write the results that are ready"""
+        if self.order == ORDER_SUBMITTED:
+            while self.pending and self.pending[0][2].done():
+                self.write(*self.pending.popleft())
+            return
+
+        not_done = deque()
+        for entry in self.pending:
+            if entry[2].done():
+                self.write(*entry)
+            else:
+                not_done.append(entry)
+        self.pending = not_done
+
+    def write(self, request_id: Any, tool_name: str, future: Future, duplicate: bool):
+        """Write a result line"""
+        response = get_response(future)
+        if response["error"]:
+            self.errors += 1
+
+        line = {
+            "request_id": request_id,
+            "tool": tool_name,
+            "result": response["result"],
+            "extras": response["extras"],
+            "error": response["error"],
+            "latency": response["latency"],
+            "deduplicated": duplicate,
+        }
+        self.output.write(json.dumps(line, default=str) + "\n")
+        self.output.flush()
+
+    def drain(self):
+        """Wait for all the requests and write their results"""
+        while self.running:
+            self.wait_for_any()
+        self.flush()
+
+    def get_stats(self, elapsed: float) -> Dict[str, Any]:
+        """Throughput and latency statistics"""
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        stats = {
+            "requests": self.total,
+            "executed": len(latencies),
+            "deduplicated": self.duplicates,
+            "errors": self.errors,
+            "elapsed": elapsed,
+            "throughput": self.total / elapsed if elapsed else 0,
+        }
+        if latencies:
+            stats |= {
+                "latency_mean": statistics.fmean(latencies),
+                "latency_p50": percentile(0.50),
+                "latency_p95": percentile(0.95),
+                "latency_max": latencies[-1],
+            }
+        return stats
+
+
+def main(argv=None):
+    """Run a batch of mech requests"""
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", help="JSONL file with a mech request per line")
+    parser.add_argument(
+        "--output", default="-", help="JSONL file for the results (default: stdout)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="Number of workers"
+    )
+    parser.add_argument(
+        "--executor",
+        choices=("thread", "process"),
+        default="thread",
+        help="Run the requests on threads or processes",
+    )
+    parser.add_argument(
+        "--order",
+        choices=(ORDER_SUBMITTED, ORDER_COMPLETED),
+        default=ORDER_SUBMITTED,
+        help="Write results in input order or as soon as they complete",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=None,
+        help="Max requests running or waiting to be written (default: 4 per worker)",
+    )
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="Execute identical requests more than once",
+    )
+    parser.add_argument(
+        "--dedup-cache",
+        type=int,
+        default=DEFAULT_DEDUP_CACHE_SIZE,
+        help="Number of recent unique requests remembered for deduplication",
+    )
+    args = parser.parse_args(argv)
+
+    load_dotenv(override=True)
+
+    executor_class = (
+        ProcessPoolExecutor if args.executor == "process" else ThreadPoolExecutor
+    )
+    output = (
+        sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    )
+
+    start = time.perf_counter()
+    try:
+        with executor_class(max_workers=args.workers) as executor:
+            runner = BatchRunner(
+                executor,
+                output,
+                order=args.order,
+                max_pending=args.max_pending or 4 * args.workers,
+                deduplicate=not args.no_dedup,
+                api_keys=get_api_keys(),
+                dedup_cache_size=args.dedup_cache,
+            )
+            for line_number, line in read_requests(args.input):
+                runner.submit(line_number, line)
+            runner.drain()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    stats = runner.get_stats(time.perf_counter() - start)
+    print(json.dumps(stats, indent=4), file=sys.stderr)
+    return stats
+
+
+if __name__ == "__main__":
+    main()
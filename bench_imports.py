@@ -0,0 +1,70 @@
+"""Measure the import time of every local tool module"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+from batch_runner import REPO_ROOT, get_tool_callables
+
+DEFAULT_REPEATS = 5
+
+# Imports the module in a fresh interpreter and prints the elapsed seconds
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module_name}
+print(time.perf_counter() - start)
+"""
+
+
+def measure_import(module_name: str) -> float:
+    """Import time of a module in a fresh interpreter"""
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-W",
+            "ignore",
+            "-c",
+            IMPORT_SNIPPET.format(module_name=module_name),
+        ],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    """Benchmark the tool imports"""
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--repeats", type=int, default=DEFAULT_REPEATS, help="Imports per module"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="Fail if the median import time of a module exceeds this (in seconds)",
+    )
+    args = parser.parse_args(argv)
+
+    over_budget = []
+    for tool_name, (module_name, _) in sorted(get_tool_callables().items()):
+        times = [measure_import(module_name) for _ in range(args.repeats)]
+        median = statistics.median(times)
+        print(
+            f"{tool_name:<25} median={median * 1e3:8.1f}ms min={min(times) * 1e3:8.1f}ms"
+        )
+        if args.budget is not None and median > args.budget:
+            over_budget.append(tool_name)
+
+    if over_budget:
+        print(f"Over the {args.budget}s import budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
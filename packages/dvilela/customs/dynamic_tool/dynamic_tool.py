@@ -4,8 +4,6 @@ import os
 import re
 from typing import Any, Dict, Optional, Tuple
 
-import google.generativeai as genai
-
 DEFAULT_MODEL = "gemini-2.0-flash"
 DEFAULT_TEMPERATURE = 1.5
 
@@ -55,6 +53,8 @@ def evaluate_code(code, **kwargs):
 
 def is_gemini_api_key_valid(gemini_api_key: str):
     """Validates whether an API key is valid"""
+    import google.generativeai as genai
+
     try:
         genai.configure(api_key=gemini_api_key)
         model = genai.GenerativeModel(DEFAULT_MODEL)
@@ -79,6 +79,8 @@ def dynamic_tool(
     temperature: the LLM model's temperature
     kwargs: the keyword argument the generated function is expected to take
     """
+    # Gemini is imported on first use, to keep the tool cheap to import
+    import google.generativeai as genai
 
     # Model has to be temporarily fixed as the agent keeps trying to use it paid models
     model_name = DEFAULT_MODEL
@@ -1,20 +1,33 @@
 """Contains the job definitions"""
 
-import functools
+import asyncio
+import contextvars
 import importlib
-import inspect
+import itertools
 import os
 import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from types import ModuleType
+from typing import Any, Dict, List, Optional, Tuple
 
-import google.generativeai as genai
 import yaml
-from google.api_core.exceptions import InternalServerError, ResourceExhausted
+
+from packages.dvilela.customs.orchestrator_tool.tracing import (
+    Tracer,
+    current_tracer,
+    instrument_module,
+    span,
+)
 
 DEFAULT_TEMPERATURE = 1.5
 DEFAULT_MODEL = "gemini-2.0-flash"
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_CONCURRENT_GOALS = 16
+RATE_LIMIT_INTERVAL = 10
+RESOURCE_EXHAUSTED_SLEEP = 30
 
 SYSTEM_PROMPT = """
 Your target is the following:
@@ -30,38 +43,15 @@ def error_response(msg: str) -> Tuple[str, None, None, None]:
     return msg, None, None, None
 
 
-def rate_limit(interval: int = 5):
-    """Rate limit a function call"""
-
-    def decorator(func):
-        # Needs to be a mutable to store state
-        # We initialize it so we do not wait for some time before the first call
-        last_called = [time.time() - interval]
-
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            now = time.time()
-            elapsed = now - last_called[0]
-
-            if elapsed < interval:
-                time.sleep(interval - elapsed)
-
-            last_called[0] = time.time()
-            return func(*args, **kwargs)
-
-        return wrapper
-
-    return decorator
-
-
 def finalize_tool():
     """This function signals the end of the execution"""
 
 
-def get_local_tools():
-    """Get all the local mech tools"""
+def get_local_tools() -> Tuple[List, List[ModuleType]]:
+    """Get all the local mech tools, and the modules they were loaded from"""
 
     tools = [finalize_tool]
+    modules = []
 
     # Get tool paths, excluding this tool
     repo_root = Path(__file__).parent.parent.parent.parent.parent
@@ -84,87 +74,240 @@ def get_local_tools():
                 module = importlib.util.module_from_spec(spec)
                 sys.modules[module_name] = module
                 spec.loader.exec_module(module)
+                modules.append(module)
 
                 for attr_name in dir(module):
                     attr = getattr(module, attr_name)
                     if callable(attr) and attr_name.endswith("_tool"):
-                        globals()[attr_name] = attr
                         tools.append(attr)
-    return tools
+    return tools, modules
 
 
-@rate_limit(interval=10)
-def send_message(chat, message):
-    """Send a message to the chat"""
-    while True:
-        try:
-            result = chat.send_message(message)
-            return result
-        except ResourceExhausted:
-            print("Hit rate limit. Retrying...")
-            time.sleep(30)
-            pass
+class AsyncRateLimiter:
+    """Rate limiter shared by all the coroutines running on an event loop"""
 
+    def __init__(self, interval: int = RATE_LIMIT_INTERVAL):
+        self.interval = interval
+        # We initialize it so we do not wait for some time before the first call
+        self.last_called = time.time() - interval
+        self.lock = asyncio.Lock()
 
-def orchestrate(model_name: str, goal: str, gemini_api_key: str):
-    """Orchestrate all the available tools through Gemini"""
+    async def wait(self):
+        """Wait until the next call is allowed"""
+        # Waiting for the lock is part of the delay: other goals are queued ahead
+        with span("rate_limit", cat="sleep"):
+            async with self.lock:
+                elapsed = time.time() - self.last_called
 
-    genai.configure(api_key=gemini_api_key)
-    model = genai.GenerativeModel(model_name=model_name, tools=get_local_tools())
-    chat = model.start_chat()
-    response_parts = None
-    result = None
+                if elapsed < self.interval:
+                    await asyncio.sleep(self.interval - elapsed)
 
-    while True:
-        # Receive a call request
-        try:
-            call_request = send_message(
-                chat, response_parts or SYSTEM_PROMPT.format(goal=goal)
+                self.last_called = time.time()
+
+
+def get_function_call(call_request):
+    """Get the first function call request from a model response"""
+    for part in call_request.parts:
+        if part.function_call:
+            return part.function_call
+    return None
+
+
+def build_response_parts(name: str, result: Any) -> List:
+    """Build the function response to send back to the model"""
+    import google.generativeai as genai
+
+    return [
+        genai.protos.Part(
+            function_response=genai.protos.FunctionResponse(
+                name=name, response={"result": result}
             )
-        except InternalServerError:
-            print("Exception")
-            continue
-
-        # Get the function call request
-        fn = None
-        for part in call_request.parts:
-            fn = part.function_call
-            if not fn:
-                continue
-            break
-
-        if not fn:
-            print("No function to call")
-            break
-
-        if fn.name == "finalize_tool":
-            print(f"Execution has finalized. Result = {result}")
-            break
-
-        # Make the call
+        )
+    ]
+
+
+class OrchestratorServer:
+    """
+    Orchestrate many goals concurrently on a single event loop.
+
+    The loop runs on a background thread for the lifetime of the server, so
+    all goals, from any request, share the loaded tools, the model and the
+    rate limiter. Tool calls are blocking, so they run on a bounded thread pool.
+    """
+
+    def __init__(
+        self,
+        gemini_api_key: str,
+        model_name: str = DEFAULT_MODEL,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_concurrent_goals: int = DEFAULT_MAX_CONCURRENT_GOALS,
+        rate_limit_interval: int = RATE_LIMIT_INTERVAL,
+    ):
+        import google.generativeai as genai
+
+        genai.configure(api_key=gemini_api_key)
+        self.tools, self.modules = get_local_tools()
+        self.instrumented = False
+        self.registry = {tool.__name__: tool for tool in self.tools}
+        self.model = genai.GenerativeModel(model_name=model_name, tools=self.tools)
+        self.rate_limiter = AsyncRateLimiter(rate_limit_interval)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="orchestrator_tool"
+        )
+        self.goal_semaphore = asyncio.Semaphore(max_concurrent_goals)
+        self.goal_ids = itertools.count()
+
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(
+            target=self.loop.run_forever, name="orchestrator_loop", daemon=True
+        )
+        self.loop_thread.start()
+
+    def instrument_tools(self):
+        """Trace the stages of the tool modules (from the first traced goal on)"""
+        if not self.instrumented:
+            for module in self.modules:
+                instrument_module(module)
+            self.instrumented = True
+
+    async def send_message(self, chat, message):
+        """Send a message to the chat, respecting the shared rate limit"""
+        from google.api_core.exceptions import ResourceExhausted
+
+        for attempt in itertools.count():
+            await self.rate_limiter.wait()
+            try:
+                with span("llm_request", cat="llm", attempt=attempt):
+                    return await chat.send_message_async(message)
+            except ResourceExhausted:
+                print("Hit rate limit. Retrying...")
+                with span("resource_exhausted", cat="retry", attempt=attempt):
+                    await asyncio.sleep(RESOURCE_EXHAUSTED_SLEEP)
+
+    async def call_tool(self, name: str, args: Dict[str, Any]) -> Any:
+        """Run a blocking tool on the executor"""
+        method = self.registry[name]
+        loop = asyncio.get_running_loop()
+        tracer = current_tracer.get()
+        queued_at = tracer.now() if tracer else None
+
+        def call():
+            # Time spent waiting for a free worker is not tool time
+            if tracer is not None:
+                tracer.add_event(name, "queue", queued_at, tracer.now() - queued_at, {})
+            with span(name, cat="tool"):
+                return method(**args)
+
+        # Executor threads do not inherit the context, so the tracer is passed along
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, context.run, call)
+
+    async def orchestrate(self, goal: str, tracer: Optional[Tracer] = None) -> Any:
+        """Orchestrate the available tools to reach a single goal"""
+        from google.api_core.exceptions import InternalServerError
+
+        # Tool functions are only wrapped once tracing is used
+        if tracer is not None:
+            self.instrument_tools()
+
+        context_token = current_tracer.set(tracer)
         try:
-            print(f"Calling {fn.name}({dict(fn.args)})")
-            method = globals().get(fn.name)
-            result = method(**dict(fn.args))
-        except Exception as e:
-            print(f"Exception while calling the function: {e}")
-            continue
-
-        print(f"Result: {result}\n")
-
-        # Build the response
-        function_calls = {fn.name: result}
-
-        response_parts = [
-            genai.protos.Part(
-                function_response=genai.protos.FunctionResponse(
-                    name=fn, response={"result": val}
-                )
-            )
-            for fn, val in function_calls.items()
-        ]
-
-    return result
+            async with self.goal_semaphore:
+                goal_id = next(self.goal_ids)
+                chat = self.model.start_chat()
+                response_parts = None
+                result = None
+
+                for turn in itertools.count():
+                    with span(f"turn {turn}", cat="turn"):
+                        # Receive a call request
+                        try:
+                            call_request = await self.send_message(
+                                chat, response_parts or SYSTEM_PROMPT.format(goal=goal)
+                            )
+                        except InternalServerError:
+                            print(f"[goal {goal_id}] Exception")
+                            continue
+
+                        # Get the function call request
+                        fn = get_function_call(call_request)
+
+                        if not fn:
+                            print(f"[goal {goal_id}] No function to call")
+                            break
+
+                        if fn.name == "finalize_tool":
+                            print(
+                                f"[goal {goal_id}] Execution has finalized. Result = {result}"
+                            )
+                            break
+
+                        # Make the call
+                        try:
+                            print(
+                                f"[goal {goal_id}] Calling {fn.name}({dict(fn.args)})"
+                            )
+                            result = await self.call_tool(fn.name, dict(fn.args))
+                        except Exception as e:
+                            print(
+                                f"[goal {goal_id}] Exception while calling the function: {e}"
+                            )
+                            continue
+
+                        print(f"[goal {goal_id}] Result: {result}\n")
+
+                        # Build the response
+                        response_parts = build_response_parts(fn.name, result)
+
+                return result
+        finally:
+            current_tracer.reset(context_token)
+
+    def submit(self, goal: str, tracer: Optional[Tracer] = None) -> Future:
+        """Schedule a goal on the server loop (from any thread)"""
+        return asyncio.run_coroutine_threadsafe(
+            self.orchestrate(goal, tracer), self.loop
+        )
+
+    def run_goals(
+        self, goals: List[str], tracers: Optional[List[Tracer]] = None
+    ) -> List[Any]:
+        """Orchestrate several goals concurrently and wait for their results"""
+        tracers = tracers or [None] * len(goals)
+        futures = [self.submit(goal, tracer) for goal, tracer in zip(goals, tracers)]
+
+        results = []
+        for i, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Goal {i} failed: {e}")
+                results.append(None)
+        return results
+
+    def close(self):
+        """Stop the event loop and release the executor threads"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.executor.shutdown(wait=True)
+
+
+# Servers are kept across calls, so requests share the tools, model and rate limit
+servers: Dict[Tuple[str, str], OrchestratorServer] = {}
+servers_lock = threading.Lock()
+
+
+def get_server(
+    gemini_api_key: str,
+    model_name: str = DEFAULT_MODEL,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+) -> OrchestratorServer:
+    """Get the server of an api key and model, starting it on first use"""
+    with servers_lock:
+        key = (gemini_api_key, model_name)
+        if key not in servers:
+            servers[key] = OrchestratorServer(gemini_api_key, model_name, max_workers)
+        return servers[key]
 
 
 def run(**kwargs) -> Tuple[Optional[str], Optional[Dict[str, Any]], Any, Any]:
@@ -176,12 +319,37 @@ def run(**kwargs) -> Tuple[Optional[str], Optional[Dict[str, Any]], Any, Any]:
     if not gemini_api_key:
         return error_response("GEMINI_API_KEY was not provided")
 
-    goal = kwargs.get("goal", None)
-    if not goal:
+    model_name = kwargs.get("model", DEFAULT_MODEL)
+
+    # Tracing: the Chrome trace is written to trace_path, if provided
+    trace_path = kwargs.get("trace_path", None)
+    trace = kwargs.get("trace", False) or trace_path is not None
+
+    # Server mode: several goals are orchestrated concurrently
+    goals = kwargs.get("goals", None)
+    single = not goals
+    if single:
+        goals = [kwargs.get("goal", None)]
+
+    if not all(goals):
         return error_response("Goal was not provided")
 
-    model_name = kwargs.get("model", DEFAULT_MODEL)
+    max_workers = int(kwargs.get("max_workers", DEFAULT_MAX_WORKERS))
+    server = get_server(gemini_api_key, model_name, max_workers)
+    tracers = [Tracer() for _ in goals] if trace else None
+    results = server.run_goals(goals, tracers)
+
+    if single:
+        results = results[0]
+
+    if not trace:
+        return results, None, None, None
 
-    result = orchestrate(model_name, goal, gemini_api_key)
+    if trace_path and single:
+        tracers[0].export(trace_path)
+    elif trace_path:
+        root, extension = os.path.splitext(trace_path)
+        for i, tracer in enumerate(tracers):
+            tracer.export(f"{root}_{i}{extension}")
 
-    return result, None, None, None
+    return results, Tracer.merge(tracers).summary(), None, None
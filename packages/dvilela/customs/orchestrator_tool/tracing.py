@@ -0,0 +1,165 @@
+"""Execution tracing in the Chrome trace event format"""
+
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, List, Optional
+
+# The tracer of the orchestration that is running in the current context
+current_tracer: contextvars.ContextVar[Optional["Tracer"]] = contextvars.ContextVar(
+    "current_tracer", default=None
+)
+
+
+class Tracer:
+    """
+    Collect timed spans of an execution.
+
+    Spans are stored as Chrome trace complete events, so they can be loaded
+    in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+
+    @classmethod
+    def merge(cls, tracers: List["Tracer"]) -> "Tracer":
+        """A tracer with the spans of several tracers, to summarize them together"""
+        merged = cls()
+        for tracer in tracers:
+            with tracer.lock:
+                merged.events.extend(tracer.events)
+        return merged
+
+    def now(self) -> float:
+        """Microseconds since the tracer was created"""
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def span(self, name: str, cat: str = "stage", **args):
+        """Record the duration of the wrapped block"""
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_event(name, cat, start, self.now() - start, args)
+
+    def add_event(
+        self, name: str, cat: str, ts: float, dur: float, args: Dict[str, Any]
+    ):
+        """Add a complete event"""
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": ts,
+            "dur": dur,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": {key: str(value) for key, value in args.items()},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """Export the spans as a Chrome trace"""
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str):
+        """Write the Chrome trace to a file"""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_chrome_trace(), file)
+
+    def time_by_category(self) -> Dict[str, float]:
+        """
+        Total milliseconds spent on each category of span.
+
+        Turns contain the rest of the categories and stages can be nested,
+        so only llm, sleep, retry, queue and tool are disjoint.
+        """
+        totals: Dict[str, float] = {}
+        with self.lock:
+            for event in self.events:
+                totals[event["cat"]] = totals.get(event["cat"], 0) + event["dur"] / 1e3
+        return totals
+
+    def tool_latency(self) -> Dict[str, Dict[str, float]]:
+        """Aggregated latency (in milliseconds) of each tool"""
+        durations: Dict[str, List[float]] = {}
+        with self.lock:
+            for event in self.events:
+                if event["cat"] == "tool":
+                    durations.setdefault(event["name"], []).append(event["dur"] / 1e3)
+
+        return {
+            name: {
+                "calls": len(values),
+                "total_ms": sum(values),
+                "mean_ms": sum(values) / len(values),
+                "max_ms": max(values),
+            }
+            for name, values in durations.items()
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        """Latency summary of the execution (the full trace is only exported)"""
+        return {
+            "tool_latency": self.tool_latency(),
+            "time_by_category": self.time_by_category(),
+        }
+
+
+def span(name: str, cat: str = "stage", **args):
+    """Record a span on the current tracer, if any"""
+    tracer = current_tracer.get()
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, cat, **args)
+
+
+def traced(func, cat: str = "stage"):
+    """Record every call to a function as a span"""
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with span(func.__name__, cat):
+                return await func(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__, cat):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def instrument_module(module):
+    """
+    Trace the stages of a tool module.
+
+    Functions defined in the module are replaced by traced versions. As they
+    call each other through the module globals, nested calls are traced too.
+    Tool entry points are skipped, since the orchestrator traces those.
+    """
+    for attr_name, attr in list(vars(module).items()):
+        if (
+            inspect.isfunction(attr)
+            and attr.__module__ == module.__name__
+            and not attr_name.endswith("_tool")
+            and not hasattr(attr, "__wrapped__")
+        ):
+            setattr(module, attr_name, traced(attr))
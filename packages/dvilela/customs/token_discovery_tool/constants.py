@@ -6,6 +6,12 @@ STABLECOINS = {
     "0x6B175474E89094C44Da98b954EedeAC495271d0F": "DAI",
 }
 
+BASE_TOKEN_ADDRESES_BASE = {
+    "WETH": "0x4200000000000000000000000000000000000006",
+    "USDC": "0x833589fcd6edb6e08f4c7c32d4f71b54bda02913",
+    "USDT": "0xfde4C96c8593536E31F229EA8f37b2ADa2699bb2",
+}
+
 # ABI necesarios
 UNISWAP_FACTORY_ABI = [
     {
@@ -0,0 +1,122 @@
+"""Columnar pool data for vectorized liquidity and age scoring"""
+
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from packages.dvilela.customs.token_discovery_tool.constants import (
+    BASE_TOKEN_ADDRESES_BASE,
+)
+
+BASE_ADDRESSES = {address.lower() for address in BASE_TOKEN_ADDRESES_BASE.values()}
+WETH_ADDRESS = BASE_TOKEN_ADDRESES_BASE["WETH"].lower()
+
+
+def get_new_token(
+    token_0_info: Dict[str, Any], token_1_info: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """Get the token paired with a base token, if any"""
+    is_base_0 = token_0_info["address"].lower() in BASE_ADDRESSES
+    is_base_1 = token_1_info["address"].lower() in BASE_ADDRESSES
+    if is_base_0 == is_base_1:
+        return None
+    return token_1_info if is_base_0 else token_0_info
+
+
+class PoolColumns:
+    """
+    Pool data held in NumPy arrays, one entry per pool.
+
+    Reserves are scaled by their decimals once, when the columns are built.
+    Liquidity, token age and the threshold masks are then computed over all
+    the pools at once.
+    """
+
+    def __init__(
+        self,
+        pairs: List[str],
+        tokens_0: List[Dict[str, Any]],
+        tokens_1: List[Dict[str, Any]],
+        reserves: Sequence[Sequence[int]],
+        blocks: Optional[Sequence[int]] = None,
+        token_timestamps: Optional[Sequence[Optional[int]]] = None,
+    ):
+        self.pairs = pairs
+        self.tokens_0 = tokens_0
+        self.tokens_1 = tokens_1
+        size = len(pairs)
+
+        # Raw reserves can exceed 64 bits, so they are converted to floats
+        reserve0 = np.array([reserve[0] for reserve in reserves], dtype=np.float64)
+        reserve1 = np.array([reserve[1] for reserve in reserves], dtype=np.float64)
+        decimals0 = np.array([token["decimals"] for token in tokens_0], dtype=np.int64)
+        decimals1 = np.array([token["decimals"] for token in tokens_1], dtype=np.int64)
+        self.reserve0 = reserve0 / np.power(10.0, decimals0)
+        self.reserve1 = reserve1 / np.power(10.0, decimals1)
+
+        address0 = [token["address"].lower() for token in tokens_0]
+        address1 = [token["address"].lower() for token in tokens_1]
+        self.is_base_0 = np.array([a in BASE_ADDRESSES for a in address0], dtype=bool)
+        self.is_base_1 = np.array([a in BASE_ADDRESSES for a in address1], dtype=bool)
+
+        # Only pools that pair a new token with a base token are considered
+        self.is_valid = self.is_base_0 ^ self.is_base_1
+
+        self.base_reserve = np.where(self.is_base_0, self.reserve0, self.reserve1)
+        self.base_is_weth = np.where(
+            self.is_base_0,
+            np.array([a == WETH_ADDRESS for a in address0], dtype=bool),
+            np.array([a == WETH_ADDRESS for a in address1], dtype=bool),
+        )
+
+        self.blocks = np.array(
+            blocks if blocks is not None else np.zeros(size), dtype=np.int64
+        )
+        self.token_timestamps = np.array(
+            [
+                np.nan if timestamp is None else timestamp
+                for timestamp in (token_timestamps or [None] * size)
+            ],
+            dtype=np.float64,
+        )
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def new_token(self, i: int) -> Dict[str, Any]:
+        """Info of the (non-base) token of a pool"""
+        return self.tokens_1[i] if self.is_base_0[i] else self.tokens_0[i]
+
+    def has_weth_pools(self, from_block: int = 0) -> bool:
+        """Whether any pool needs the price of ETH to be valued"""
+        return bool(
+            (self.is_valid & self.base_is_weth & (self.blocks >= from_block)).any()
+        )
+
+    def liquidity(self, eth_price: float) -> np.ndarray:
+        """Liquidity of every pool in USD, assuming stablecoins are worth 1 USD"""
+        base_price = np.where(self.base_is_weth, eth_price, 1.0)
+        return np.where(self.is_valid, self.base_reserve * base_price * 2, 0.0)
+
+    def age_hours(self, now: Optional[float] = None) -> np.ndarray:
+        """Age of every new token in hours (NaN if unknown)"""
+        now = now or datetime.now().timestamp()
+        return (now - self.token_timestamps) / 3600
+
+    def select(
+        self,
+        liquidity: np.ndarray,
+        liquidity_threshold: float,
+        deployment_threshold: float,
+        from_block: int = 0,
+        now: Optional[float] = None,
+    ) -> np.ndarray:
+        """Mask of the pools that are new, liquid and recent enough"""
+        # Comparisons with NaN are False, so tokens of unknown age are left out
+        return (
+            self.is_valid
+            & (self.blocks >= from_block)
+            & (liquidity >= liquidity_threshold)
+            & (self.age_hours(now) < deployment_threshold)
+        )
@@ -0,0 +1,362 @@
+"""Local index of the discovered pools"""
+
+import fcntl
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from packages.dvilela.customs.token_discovery_tool.pool_columns import PoolColumns
+
+POOL_RECORD = "pool"
+RESERVES_RECORD = "reserves"
+POPULARITY_RECORD = "popularity"
+CHECKPOINT_RECORD = "checkpoint"
+COMPACTION_RECORD = "compaction"
+
+# The file is rewritten with the latest state once most of its records are stale
+COMPACTION_MIN_RECORDS = 10000
+COMPACTION_RATIO = 2
+
+
+class PoolIndex:
+    """
+    Append-only index of the discovered pools.
+
+    Every discovery is appended as a JSON line (pools, reserve snapshots,
+    popularity snapshots and the indexed block ranges) and replayed on load,
+    so the chain only needs to be scanned for blocks that were not indexed yet.
+    Queries run as vectorized filters over a columnar view of the pools.
+
+    Appends take an exclusive lock on the file and first replay the records
+    that other processes appended since, so several workers can share a file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.pools: Dict[str, Dict[str, Any]] = {}
+        self.reserves: Dict[str, Dict[str, Any]] = {}
+        self.popularity: Dict[str, Dict[str, Any]] = {}
+
+        # Indexed block ranges, sorted and merged: [(from_block, to_block), ...]
+        self.indexed_ranges: List[Tuple[int, int]] = []
+
+        # Columnar view of the pools, rebuilt after new records are applied
+        self.columns: Optional[PoolColumns] = None
+
+        # First line of the replayed file (it changes when the file is compacted),
+        # replay position, and records replayed since the last compaction
+        self.header: Optional[bytes] = None
+        self.offset = 0
+        self.records = 0
+
+        self.load()
+
+    def load(self):
+        """Replay the index file"""
+        with self.lock, self.open_locked():
+            pass
+
+    @contextmanager
+    def open_locked(self):
+        """Open the index file with an exclusive lock, replaying the new records"""
+        while True:
+            file = open(self.path, "a+b")
+            fcntl.flock(file, fcntl.LOCK_EX)
+            # The file may have been compacted (replaced) while waiting for the lock
+            if os.fstat(file.fileno()).st_ino == os.stat(self.path).st_ino:
+                break
+            file.close()
+
+        try:
+            self.replay(file)
+            yield file
+        finally:
+            file.close()
+
+    def replay(self, file):
+        """Apply the records that were appended since the last replay"""
+        file.seek(0)
+        header = file.readline()
+        if header != self.header:
+            self.reset()
+            self.header = header
+
+        file.seek(self.offset)
+        for line in file:
+            # Records are written with their newline at once, so this one was cut short
+            if not line.endswith(b"\n"):
+                print(f"Dropping an incomplete record at the end of {self.path}")
+                file.truncate(self.offset)
+                break
+
+            try:
+                if line.strip():
+                    self.apply(json.loads(line))
+                    self.records += 1
+            except (ValueError, KeyError) as e:
+                print(f"Skipping an invalid record in {self.path}: {e}")
+
+            self.offset += len(line)
+
+    def reset(self):
+        """Forget the replayed records"""
+        self.pools.clear()
+        self.reserves.clear()
+        self.popularity.clear()
+        self.indexed_ranges = []
+        self.columns = None
+        self.offset = 0
+        self.records = 0
+
+    def apply(self, record: Dict[str, Any]):
+        """Apply a record to the in-memory index"""
+        record_type = record["type"]
+
+        if record_type == POOL_RECORD:
+            self.pools[record["pair"]] = record
+            self.columns = None
+
+        elif record_type == RESERVES_RECORD:
+            # Keep the newest snapshot
+            latest = self.reserves.get(record["pair"])
+            if latest is None or record["block"] >= latest["block"]:
+                self.reserves[record["pair"]] = record
+                self.columns = None
+
+        elif record_type == POPULARITY_RECORD:
+            self.popularity[record["token"]] = record
+
+        elif record_type == CHECKPOINT_RECORD:
+            self.add_indexed_range(record["from_block"], record["to_block"])
+
+    def add_indexed_range(self, from_block: int, to_block: int):
+        """Mark a block range as indexed, merging it with the adjacent ranges"""
+        merged = []
+        for start, end in sorted(self.indexed_ranges + [(from_block, to_block)]):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.indexed_ranges = merged
+
+    def append(self, records: List[Dict[str, Any]]):
+        """Persist and apply new records"""
+        if not records:
+            return
+
+        with self.lock, self.open_locked() as file:
+            data = "".join(json.dumps(record) + "\n" for record in records).encode()
+            file.write(data)
+            file.flush()
+            self.offset += len(data)
+
+            for record in records:
+                self.apply(record)
+            self.records += len(records)
+
+            if self.needs_compaction():
+                self.compact()
+
+    def needs_compaction(self) -> bool:
+        """Whether most of the records in the file were superseded"""
+        live_records = (
+            len(self.pools)
+            + len(self.reserves)
+            + len(self.popularity)
+            + len(self.indexed_ranges)
+        )
+        return (
+            self.records >= COMPACTION_MIN_RECORDS
+            and self.records > COMPACTION_RATIO * live_records
+        )
+
+    def compact(self):
+        """Rewrite the file with only the latest records (with the file locked)"""
+        records = (
+            [{"type": COMPACTION_RECORD, "id": uuid.uuid4().hex}]
+            + list(self.pools.values())
+            + list(self.reserves.values())
+            + list(self.popularity.values())
+            + [
+                self.checkpoint_record(from_block, to_block)
+                for from_block, to_block in self.indexed_ranges
+            ]
+        )
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+        print(f"Compacted {self.path}: {self.records} -> {len(records)} records")
+        self.header = data[: data.index(b"\n") + 1]
+        self.offset = len(data)
+        self.records = len(records)
+
+    def missing_ranges(self, from_block: int, to_block: int) -> List[Tuple[int, int]]:
+        """Block ranges between from_block and to_block that were not indexed yet"""
+        ranges = []
+        start = from_block
+        for indexed_start, indexed_end in self.indexed_ranges:
+            if indexed_end < start:
+                continue
+            if indexed_start > to_block:
+                break
+            if indexed_start > start:
+                ranges.append((start, indexed_start - 1))
+            start = max(start, indexed_end + 1)
+
+        if start <= to_block:
+            ranges.append((start, to_block))
+        return ranges
+
+    def latest_block(self) -> Optional[int]:
+        """Last indexed block, if any"""
+        return self.indexed_ranges[-1][1] if self.indexed_ranges else None
+
+    def stale_pairs(self, from_block: int, min_reserves_block: int) -> List[str]:
+        """Pools since from_block whose reserves were read before min_reserves_block"""
+        return [
+            pair
+            for pair, pool in self.pools.items()
+            if pool["block"] >= from_block
+            and self.reserves.get(pair, {}).get("block", -1) < min_reserves_block
+        ]
+
+    def pools_without_age(self, from_block: int) -> List[Dict[str, Any]]:
+        """Pools created at or after a block whose token creation was not found"""
+        return [
+            pool
+            for pool in self.pools.values()
+            if pool["block"] >= from_block and pool["token_timestamp"] is None
+        ]
+
+    def pool_record(
+        self,
+        pair: str,
+        token_0_info: Dict[str, Any],
+        token_1_info: Dict[str, Any],
+        block: int,
+        timestamp: int,
+        token_timestamp: Optional[int],
+    ) -> Dict[str, Any]:
+        """Build a pool record"""
+        return {
+            "type": POOL_RECORD,
+            "pair": pair,
+            "token0": token_0_info,
+            "token1": token_1_info,
+            "block": block,
+            "timestamp": timestamp,
+            "token_timestamp": token_timestamp,
+        }
+
+    def reserves_record(
+        self, pair: str, block: int, reserve0: int, reserve1: int
+    ) -> Dict[str, Any]:
+        """Build a reserves snapshot record"""
+        return {
+            "type": RESERVES_RECORD,
+            "pair": pair,
+            "block": block,
+            "reserve0": reserve0,
+            "reserve1": reserve1,
+        }
+
+    def checkpoint_record(self, from_block: int, to_block: int) -> Dict[str, Any]:
+        """Build a record marking a block range as indexed"""
+        return {
+            "type": CHECKPOINT_RECORD,
+            "from_block": from_block,
+            "to_block": to_block,
+        }
+
+    def add_popularity(self, token: str, popularity: Dict[str, Any]):
+        """Persist a popularity snapshot of a token"""
+        self.append(
+            [
+                {
+                    "type": POPULARITY_RECORD,
+                    "token": token,
+                    "timestamp": int(datetime.now().timestamp()),
+                }
+                | popularity
+            ]
+        )
+
+    def get_columns(self) -> PoolColumns:
+        """Columnar view of the indexed pools"""
+        if self.columns is None:
+            pools = list(self.pools.values())
+            self.columns = PoolColumns(
+                [pool["pair"] for pool in pools],
+                [pool["token0"] for pool in pools],
+                [pool["token1"] for pool in pools],
+                [
+                    (
+                        self.reserves[pool["pair"]]["reserve0"],
+                        self.reserves[pool["pair"]]["reserve1"],
+                    )
+                    if pool["pair"] in self.reserves
+                    else (0, 0)
+                    for pool in pools
+                ],
+                [pool["block"] for pool in pools],
+                [pool["token_timestamp"] for pool in pools],
+            )
+        return self.columns
+
+    def has_weth_pools(self, from_block: int) -> bool:
+        """Whether any pool created at or after a block is paired with WETH"""
+        with self.lock:
+            return self.get_columns().has_weth_pools(from_block)
+
+    def query(
+        self,
+        from_block: int,
+        liquidity_threshold: float,
+        deployment_threshold: float,
+        eth_price: float,
+        now: Optional[float] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Get the new tokens from the index.
+
+        from_block: only pools created at or after this block
+        liquidity_threshold: the min liquidity (in dollars) of the pool
+        deployment_threshold: the max age (in hours) of the token
+        eth_price: the price of ETH, to value the WETH reserves (NaN if unknown)
+        """
+        with self.lock:
+            columns = self.get_columns()
+            liquidity = columns.liquidity(eth_price)
+            is_new = columns.select(
+                liquidity, liquidity_threshold, deployment_threshold, from_block, now
+            )
+
+            new_tokens = []
+            for i in np.flatnonzero(is_new):
+                token = columns.new_token(i) | {"liquidity": float(liquidity[i])}
+
+                popularity = self.popularity.get(token["address"])
+                if popularity is not None:
+                    token |= {
+                        key: value
+                        for key, value in popularity.items()
+                        if key not in ("type", "token", "timestamp")
+                    }
+
+                new_tokens.append(token)
+
+        return new_tokens
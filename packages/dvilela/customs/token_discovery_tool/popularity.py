@@ -0,0 +1,209 @@
+"""Streaming popularity aggregation over Twitter search results"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+HOUR = 3600
+DEFAULT_WINDOW_HOURS = 24
+DEFAULT_TREND_HOURS = 3
+DEFAULT_MAX_SYMBOLS = 1024
+DEFAULT_MAX_TWEETS = 100
+DEFAULT_REFRESH_INTERVAL = 15 * 60
+PAGE_SIZE = 20
+
+# Engagement above which a token is considered popular (score > 1)
+POPULARITY_THRESHOLDS = {
+    "tweets": 100,
+    "likes": 1000,
+    "retweets": 1000,
+    "quotes": 100,
+}
+METRICS = tuple(POPULARITY_THRESHOLDS)
+
+
+class EngagementWindow:
+    """Hourly engagement counters of a symbol over a rolling window"""
+
+    __slots__ = ("buckets", "tweets", "last_fetched")
+
+    def __init__(self):
+        # Hour -> [tweets, likes, retweets, quotes]
+        self.buckets: Dict[int, List[int]] = {}
+        # Tweet id -> (hour, likes, retweets, quotes) when it was last seen
+        self.tweets: Dict[int, Tuple[int, int, int, int]] = {}
+        self.last_fetched = 0.0
+
+    def add(
+        self,
+        tweet_id: int,
+        timestamp: float,
+        likes: int,
+        retweets: int,
+        quotes: int,
+        now: float,
+    ):
+        """
+        Count a new tweet in the hour it was posted. For a tweet seen before,
+        count the engagement it gained since in the current hour.
+        """
+        hour = int(timestamp // HOUR)
+        seen = self.tweets.get(tweet_id)
+
+        if seen is None:
+            bucket = self.buckets.setdefault(hour, [0, 0, 0, 0])
+            bucket[0] += 1
+            engagement = (likes, retweets, quotes)
+        else:
+            bucket = self.buckets.setdefault(int(now // HOUR), [0, 0, 0, 0])
+            engagement = (likes - seen[1], retweets - seen[2], quotes - seen[3])
+
+        for i, value in enumerate(engagement, start=1):
+            bucket[i] += value
+        self.tweets[tweet_id] = (hour, likes, retweets, quotes)
+
+    def prune(self, oldest_hour: int):
+        """Drop the buckets and tweets that fell out of the window"""
+        for hour in [hour for hour in self.buckets if hour < oldest_hour]:
+            del self.buckets[hour]
+        for tweet_id in [
+            tweet_id
+            for tweet_id, (hour, *_) in self.tweets.items()
+            if hour < oldest_hour
+        ]:
+            del self.tweets[tweet_id]
+
+    def totals(self, from_hour: int, to_hour: int) -> Dict[str, int]:
+        """Engagement between two hours (both included)"""
+        totals = [0, 0, 0, 0]
+        for hour, bucket in self.buckets.items():
+            if from_hour <= hour <= to_hour:
+                totals = [total + value for total, value in zip(totals, bucket)]
+        return dict(zip(METRICS, totals))
+
+
+class PopularityStore:
+    """
+    Bounded store of rolling engagement windows, by token symbol.
+
+    Tweets are aggregated into hourly counters as search pages arrive. Only
+    the last seen engagement of each tweet is kept, so a tweet that shows up
+    again adds what it gained since. Symbols that were searched
+    recently are not searched again, and the least recently used symbols
+    are evicted once the store is full.
+    """
+
+    def __init__(
+        self,
+        window_hours: int = DEFAULT_WINDOW_HOURS,
+        trend_hours: int = DEFAULT_TREND_HOURS,
+        max_symbols: int = DEFAULT_MAX_SYMBOLS,
+        refresh_interval: float = DEFAULT_REFRESH_INTERVAL,
+    ):
+        self.window_hours = window_hours
+        self.trend_hours = trend_hours
+        self.max_symbols = max_symbols
+        self.refresh_interval = refresh_interval
+        self.windows: OrderedDict[str, EngagementWindow] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_window(self, symbol: str) -> EngagementWindow:
+        """Get the window of a symbol, evicting the least recently used ones"""
+        with self.lock:
+            window = self.windows.pop(symbol, None) or EngagementWindow()
+            self.windows[symbol] = window
+            while len(self.windows) > self.max_symbols:
+                self.windows.popitem(last=False)
+            return window
+
+    def needs_refresh(self, window: EngagementWindow, now: float) -> bool:
+        """Whether a window is too old to be used without searching again"""
+        return now - window.last_fetched >= self.refresh_interval
+
+    def get_popularity(
+        self, window: EngagementWindow, now: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Popularity of a symbol.
+
+        score: engagement relative to the popularity thresholds (popular if > 1)
+        trend: engagement per hour in the latest hours minus the rest of the window,
+            relative to the popularity thresholds (for the fastest growing metric)
+        """
+        now = now or time.time()
+        current_hour = int(now // HOUR)
+        oldest_hour = current_hour - self.window_hours + 1
+        recent_hour = current_hour - self.trend_hours + 1
+
+        with self.lock:
+            window.prune(oldest_hour)
+            totals = window.totals(oldest_hour, current_hour)
+            recent = window.totals(recent_hour, current_hour)
+            previous = window.totals(oldest_hour, recent_hour - 1)
+
+        score = max(
+            totals[metric] / threshold
+            for metric, threshold in POPULARITY_THRESHOLDS.items()
+        )
+        previous_hours = max(1, self.window_hours - self.trend_hours)
+        trend = max(
+            (recent[metric] / self.trend_hours - previous[metric] / previous_hours)
+            / threshold
+            for metric, threshold in POPULARITY_THRESHOLDS.items()
+        )
+
+        return {
+            "popularity_score": score,
+            "popularity_trend": trend,
+            "is_popular": score > 1,
+        } | {f"window_{metric}": value for metric, value in totals.items()}
+
+    async def aggregate(
+        self,
+        twikit_client: Any,
+        symbol: str,
+        max_tweets: int = DEFAULT_MAX_TWEETS,
+        now: Optional[float] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Search the tweets about a symbol and aggregate their engagement"""
+        now = now or time.time()
+        window = self.get_window(symbol)
+
+        if not self.needs_refresh(window, now):
+            return self.get_popularity(window, now)
+
+        query = symbol if symbol.startswith("$") else f"${symbol}"
+        oldest_hour = int(now // HOUR) - self.window_hours + 1
+        seen = 0
+
+        try:
+            page = await twikit_client.search_tweet(
+                f"{query} -is:retweet", product="Top", count=PAGE_SIZE
+            )
+            while page and seen < max_tweets:
+                for tweet in page:
+                    seen += 1
+                    timestamp = tweet.created_at_datetime.timestamp()
+
+                    if timestamp >= oldest_hour * HOUR:
+                        with self.lock:
+                            window.add(
+                                int(tweet.id),
+                                timestamp,
+                                tweet.favorite_count or 0,
+                                tweet.retweet_count or 0,
+                                tweet.quote_count or 0,
+                                now,
+                            )
+
+                    if seen >= max_tweets:
+                        break
+                else:
+                    page = await page.next()
+        except Exception as e:
+            print(f"Exception while getting the tweets: {e}")
+            return None
+
+        window.last_fetched = now
+        return self.get_popularity(window, now)
@@ -4,13 +4,9 @@ import asyncio
 import json
 import os
 import tempfile
-from datetime import datetime
+import time
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
-
-import requests
-from twikit import Client
-from web3 import Web3
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 from packages.dvilela.customs.token_discovery_tool.constants import (
     ERC20_ABI,
@@ -18,54 +14,56 @@ from packages.dvilela.customs.token_discovery_tool.constants import (
     UNISWAP_POOL_ABI,
     UNISWAP_V2_FACTORY,
 )
+from packages.dvilela.customs.token_discovery_tool.popularity import PopularityStore
+
+# Heavy dependencies are imported on first use, to keep the tool cheap to import
+if TYPE_CHECKING:
+    from twikit import Client
+
+    from packages.dvilela.customs.token_discovery_tool.pool_index import PoolIndex
 
 DEFAULT_BLOCK_RANGE = 1000
 DEFAULT_LIQUIDITY_THRESHOLD = 1000
 DEFAULT_DEPLOYMENT_THRESHOLD = 24
+DEFAULT_MAX_RESERVES_AGE = 150
+LOGS_CHUNK_SIZE = 2000
+PRICE_REQUEST_TIMEOUT = 10
+ETH_PRICE_TTL = 60
+RESERVES_BATCH_SIZE = 100
+
+# Engagement windows are kept across calls, so recent searches are not repeated
+popularity_store = PopularityStore()
+
+# Latest [timestamp, price] of ETH, so repeated queries do not request it again
+eth_price_cache = [0.0, float("nan")]
+
+
+def get_eth_price() -> float:
+    """Get the current price of Ethereum (NaN if it is not available)"""
+    import requests
+
+    if time.time() - eth_price_cache[0] < ETH_PRICE_TTL:
+        return eth_price_cache[1]
 
-BASE_TOKEN_ADDRESES_BASE = {
-    "WETH": "0x4200000000000000000000000000000000000006",
-    "USDC": "0x833589fcd6edb6e08f4c7c32d4f71b54bda02913",
-    "USDT": "0xfde4C96c8593536E31F229EA8f37b2ADa2699bb2",
-}
-
-twikit_client = Client(language="en-US")
-
-
-def tweet_to_json(tweet: Any, user_id: Optional[str] = None) -> Dict:
-    """Tweet to json"""
-    return {
-        "id": tweet.id,
-        "user_name": tweet.user.name,
-        "user_id": user_id or tweet.user.id,
-        "text": tweet.text,
-        "created_at": tweet.created_at,
-        "view_count": tweet.view_count,
-        "favorite_count": tweet.favorite_count,
-        "retweet_count": tweet.retweet_count,
-        "quote_count": tweet.quote_count,
-        "view_count_state": tweet.view_count_state,
-    }
-
-
-def get_eth_price():
-    """Get the current price of Ethereum"""
     url = "https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd"
-    response = requests.get(url)
-    return response.json()["ethereum"]["usd"]
+    try:
+        response = requests.get(url, timeout=PRICE_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        eth_price_cache[:] = [time.time(), float(response.json()["ethereum"]["usd"])]
+        return eth_price_cache[1]
+    except Exception as e:
+        # WETH pools are valued at NaN, so they never pass the liquidity threshold
+        print(f"Exception while getting the price of Ethereum: {e}")
+        return float("nan")
 
 
-def find_token_age(
-    web3, contract_address, block_range=DEFAULT_BLOCK_RANGE
+def find_creation_block(
+    web3, contract_address, start_block: int, end_block: int
 ) -> Optional[int]:
-    """Find the time when a contract was created"""
+    """Find the block where a contract was created, within a block range"""
 
     creation_block = None
 
-    # Search in the latest 5k blocks
-    end_block = web3.eth.block_number
-    start_block = end_block - block_range
-
     while start_block <= end_block:
         mid = (start_block + end_block) // 2
         code = web3.eth.get_code(contract_address, block_identifier=mid)
@@ -78,12 +76,28 @@ def find_token_age(
             creation_block = mid
             end_block = mid - 1
 
-    if not creation_block:
+    return creation_block
+
+
+def find_token_timestamp(
+    web3, contract_address, end_block: int, block_range: Optional[int] = None
+) -> Optional[int]:
+    """Find the time when a contract was created (in any block up to end_block by default)"""
+
+    # Code only appears once, so the whole chain is searched in a few dozen calls
+    start_block = 0 if block_range is None else max(0, end_block - block_range)
+    try:
+        creation_block = find_creation_block(
+            web3, contract_address, start_block, end_block
+        )
+    except Exception as e:
+        print(f"Exception while finding the creation of {contract_address}: {e}")
         return None
 
-    creation_timestamp = web3.eth.get_block(creation_block)["timestamp"]
-    token_age_hours = (datetime.now().timestamp() - creation_timestamp) / 3600
-    return token_age_hours
+    if creation_block is None:
+        return None
+
+    return web3.eth.get_block(creation_block)["timestamp"]
 
 
 def get_token_info(web3, token_address) -> Optional[Dict[str, Any]]:
@@ -99,33 +113,37 @@ def get_token_info(web3, token_address) -> Optional[Dict[str, Any]]:
         return None
 
 
-def analyze_liquidity(
-    web3, pool_address, token_0_info, token_1_info
-) -> Optional[float]:
-    """Analyze liquidity of a pool"""
+def get_reserves(web3, pool_address) -> List[int]:
+    """Get the reserves of a pool"""
     pool_contract = web3.eth.contract(address=pool_address, abi=UNISWAP_POOL_ABI)
-
-    base_token_address = (
-        token_0_info["address"]
-        if token_0_info["address"] in BASE_TOKEN_ADDRESES_BASE.values()
-        else token_1_info["address"]
-    )
-    base_is_weth = base_token_address == BASE_TOKEN_ADDRESES_BASE["WETH"]
-
-    try:
-        reserves = pool_contract.functions.getReserves().call()
-        reserve0 = reserves[0] / (10 ** token_0_info["decimals"])
-
-        if base_is_weth:
-            eth_price = get_eth_price()
-            liquidity = (reserve0 * eth_price) * 2  # Total liquidity in USD
-        else:
-            liquidity = reserve0 * 2  # Asumes the stablecoin is worth 1 USD
-
-        return liquidity
-
-    except Exception:
-        return 0
+    return pool_contract.functions.getReserves().call()
+
+
+def get_reserves_batch(web3, pool_addresses: List[str]) -> Dict[str, List[int]]:
+    """Get the reserves of several pools, in batched requests"""
+    reserves = {}
+
+    for i in range(0, len(pool_addresses), RESERVES_BATCH_SIZE):
+        chunk = pool_addresses[i : i + RESERVES_BATCH_SIZE]
+        try:
+            with web3.batch_requests() as batch:
+                for pool_address in chunk:
+                    pool_contract = web3.eth.contract(
+                        address=pool_address, abi=UNISWAP_POOL_ABI
+                    )
+                    batch.add(pool_contract.functions.getReserves())
+                responses = batch.execute()
+            reserves |= dict(zip(chunk, responses))
+        except Exception as e:
+            # Some providers do not support batches: read the pools one by one
+            print(f"Exception while getting the reserves in a batch: {e}")
+            for pool_address in chunk:
+                try:
+                    reserves[pool_address] = get_reserves(web3, pool_address)
+                except Exception:
+                    print(f"Reserves not found for {pool_address}")
+
+    return reserves
 
 
 def find_new_tokens(
@@ -135,19 +153,23 @@ def find_new_tokens(
     deployment_threshold: int = DEFAULT_DEPLOYMENT_THRESHOLD,
 ) -> List[Dict[str, Any]]:
     """Analyze newly deployed pools and find new tokens"""
+    import numpy as np
+
+    from packages.dvilela.customs.token_discovery_tool.pool_columns import (
+        PoolColumns,
+    )
+
     factory = web3.eth.contract(address=UNISWAP_V2_FACTORY, abi=UNISWAP_FACTORY_ABI)
     latest_block = web3.eth.block_number
     pool_created_logs = factory.events.PairCreated.get_logs(
-        from_block=web3.eth.block_number - block_range, to_block=latest_block
+        from_block=latest_block - block_range, to_block=latest_block
     )
     print(f"Found {len(pool_created_logs)} new pools in the last {block_range} blocks")
 
     if not pool_created_logs:
         return None
 
-    BASE_ADDRESSES = list(BASE_TOKEN_ADDRESES_BASE.values())
-
-    new_tokens = []
+    pairs, tokens_0, tokens_1 = [], [], []
 
     for log in pool_created_logs:
         token0_address = log.args.token0
@@ -162,76 +184,150 @@ def find_new_tokens(
             print(f"Token info not found for {token0_address} or {token1_address}")
             continue
 
-        liquidity = analyze_liquidity(web3, pool_address, token_0_info, token_1_info)
+        pairs.append(pool_address)
+        tokens_0.append(token_0_info)
+        tokens_1.append(token_1_info)
 
-        # Ignore tokens with low liquidity
-        if liquidity < liquidity_threshold:
+    pool_reserves = get_reserves_batch(web3, pairs)
+    reserves = [pool_reserves.get(pair, (0, 0)) for pair in pairs]
+
+    columns = PoolColumns(pairs, tokens_0, tokens_1, reserves)
+    eth_price = get_eth_price() if columns.has_weth_pools() else float("nan")
+    liquidity = columns.liquidity(eth_price)
+    is_liquid = columns.is_valid & (liquidity >= liquidity_threshold)
+
+    for i in range(len(columns)):
+        pool_name = f"{tokens_0[i]['symbol']}/{tokens_1[i]['symbol']}"
+        if is_liquid[i]:
             print(
-                f"Ignoring pool with low liquidity [{token_0_info['symbol']}/{token_1_info['symbol']}]: ${liquidity}"
+                f"Pool [{pool_name}] has enough liquidity ({liquidity[i]} >= {liquidity_threshold})"
             )
-            continue
+        else:
+            print(f"Ignoring pool with low liquidity [{pool_name}]: ${liquidity[i]}")
 
-        print(
-            f"Pool [{token_0_info['symbol']}/{token_1_info['symbol']}] has enough liquidity ({liquidity} >= {liquidity_threshold})"
+    # Finding the token creation is costly, so only liquid pools are checked
+    for i in np.flatnonzero(is_liquid):
+        token_timestamp = find_token_timestamp(
+            web3, columns.new_token(i)["address"], latest_block
         )
+        if token_timestamp is not None:
+            columns.token_timestamps[i] = token_timestamp
 
-        # Check if the token is paired with a base token and is less than 24 hours old
-        if token_0_info["address"] in BASE_ADDRESSES:
-            if find_token_age(web3, token_1_info["address"]) < deployment_threshold:
-                new_tokens.append(token_1_info | {"liquidity": liquidity})
-            else:
-                print(
-                    f"Token {token_1_info['symbol']} was deployed more than {deployment_threshold} hours ago. Ignoring."
-                )
+    is_new = columns.select(liquidity, liquidity_threshold, deployment_threshold)
 
-        if token_1_info["address"] in BASE_ADDRESSES:
-            if find_token_age(web3, token_0_info["address"]) < 24:
-                new_tokens.append(token_0_info | {"liquidity": liquidity})
-            else:
-                print(
-                    f"Token {token_0_info['symbol']} was deployed more than {deployment_threshold} hours ago. Ignoring."
-                )
+    for i in np.flatnonzero(is_liquid & ~is_new):
+        print(
+            f"Token {columns.new_token(i)['symbol']} was deployed more than {deployment_threshold} hours ago. Ignoring."
+        )
+
+    new_tokens = [
+        columns.new_token(i) | {"liquidity": float(liquidity[i])}
+        for i in np.flatnonzero(is_new)
+    ]
 
     print(f"Found {len(new_tokens)} new tokens with enough liquidity")
     return new_tokens
 
 
-async def get_tweets(token_name) -> Optional[List]:
-    """Get recent tweets about a token"""
-    token_name = token_name if token_name.startswith("$") else f"${token_name}"
-    try:
-        tweets = await twikit_client.search_tweet(
-            f"{token_name} -is:retweet", product="Top", count=100
+def update_pool_index(
+    web3,
+    index: "PoolIndex",
+    block_range: int = DEFAULT_BLOCK_RANGE,
+    max_reserves_age: int = DEFAULT_MAX_RESERVES_AGE,
+) -> int:
+    """
+    Index the pools created in the latest blocks that were not indexed yet,
+    and take a new snapshot of the reserves of the pools in those blocks that
+    were not read in the last max_reserves_age blocks.
+    """
+    from packages.dvilela.customs.token_discovery_tool.pool_columns import (
+        get_new_token,
+    )
+
+    factory = web3.eth.contract(address=UNISWAP_V2_FACTORY, abi=UNISWAP_FACTORY_ABI)
+    latest_block = web3.eth.block_number
+    chunks = [
+        (chunk_start, min(chunk_start + LOGS_CHUNK_SIZE - 1, range_end))
+        for range_start, range_end in index.missing_ranges(
+            latest_block - block_range, latest_block
         )
-        return [tweet_to_json(t) for t in tweets]
-    except Exception as e:
-        print(f"Exception while getting the tweets: {e}")
-        return None
+        for chunk_start in range(range_start, range_end + 1, LOGS_CHUNK_SIZE)
+    ]
 
+    # Each chunk is checkpointed, so an interrupted update resumes after it
+    for from_block, to_block in chunks:
+        pool_created_logs = factory.events.PairCreated.get_logs(
+            from_block=from_block, to_block=to_block
+        )
+        print(
+            f"Indexing {len(pool_created_logs)} new pools in blocks {from_block}-{to_block}"
+        )
 
-async def is_popular(token_symbol) -> Optional[bool]:
-    """
-    Check if a token is popular based on the number of likes, retweets and quotes
-    """
-    tweets = await get_tweets(token_symbol)
+        records = []
+        for log in pool_created_logs:
+            pool_address = log.args.pair
+            token_0_info = get_token_info(web3, log.args.token0)
+            token_1_info = get_token_info(web3, log.args.token1)
 
-    if tweets is None:
-        return None
+            # Ignore tokens with missing information
+            if not token_0_info or not token_1_info:
+                print(
+                    f"Token info not found for {log.args.token0} or {log.args.token1}"
+                )
+                continue
+
+            # Only pools that pair a new token with a base token
+            new_token = get_new_token(token_0_info, token_1_info)
+            if new_token is None:
+                continue
+
+            # The token was deployed before its pool
+            token_timestamp = find_token_timestamp(
+                web3, new_token["address"], log.blockNumber
+            )
+
+            records.append(
+                index.pool_record(
+                    pool_address,
+                    token_0_info,
+                    token_1_info,
+                    log.blockNumber,
+                    web3.eth.get_block(log.blockNumber)["timestamp"],
+                    token_timestamp,
+                )
+            )
+
+        records.append(index.checkpoint_record(from_block, to_block))
+        index.append(records)
 
-    total_tweets = len(tweets)
-    total_likes = sum(tweet["favorite_count"] for tweet in tweets)
-    total_retweets = sum(tweet["retweet_count"] for tweet in tweets)
-    total_quotes = sum(tweet["quote_count"] for tweet in tweets)
+    # Retry the tokens whose creation could not be found (e.g. on RPC errors)
+    records = []
+    for pool in index.pools_without_age(latest_block - block_range):
+        new_token = get_new_token(pool["token0"], pool["token1"])
+        token_timestamp = find_token_timestamp(
+            web3, new_token["address"], pool["block"]
+        )
+        if token_timestamp is not None:
+            records.append(pool | {"token_timestamp": token_timestamp})
+    index.append(records)
 
-    return (
-        total_tweets > 100
-        or total_likes > 1000
-        or total_retweets > 1000
-        or total_quotes > 100
+    # Reserves change with every swap, so old snapshots are read again
+    pairs = index.stale_pairs(
+        latest_block - block_range, latest_block - max_reserves_age
     )
+    pool_reserves = get_reserves_batch(web3, pairs)
+    print(f"Updated the reserves of {len(pool_reserves)}/{len(pairs)} pools")
+    index.append(
+        [
+            index.reserves_record(pair, latest_block, reserves[0], reserves[1])
+            for pair, reserves in pool_reserves.items()
+        ]
+    )
+
+    return latest_block
 
 
-async def twikit_login(twitter_credentials: str):
+async def twikit_login(twikit_client: "Client", twitter_credentials: str):
     """Login into Twitter"""
 
     twitter_credentials = json.loads(twitter_credentials)
@@ -251,6 +347,35 @@ async def twikit_login(twitter_credentials: str):
         print("Logged into Twitter")
 
 
+async def check_popularity(
+    tokens: List[Dict[str, Any]],
+    twitter_credentials: str,
+    index: Optional["PoolIndex"] = None,
+):
+    """Check the popularity of a list of tokens on Twitter"""
+
+    from twikit import Client
+
+    # A client per call, so concurrent tool calls do not share a session
+    twikit_client = Client(language="en-US")
+    await twikit_login(twikit_client, twitter_credentials)
+
+    for token in tokens:
+        popularity = await popularity_store.aggregate(twikit_client, token["symbol"])
+        if popularity is None:
+            token["is_popular"] = None
+            continue
+
+        token |= popularity
+        print(
+            f"Is {token['symbol']} popular? {token['is_popular']} "
+            f"(score={token['popularity_score']:.2f}, trend={token['popularity_trend']:.2f})"
+        )
+
+        if index is not None:
+            index.add_popularity(token["address"], popularity)
+
+
 def error_response(msg: str) -> Tuple[str, None, None, None]:
     """Return an error mech response."""
     return msg, None, None, None
@@ -262,6 +387,9 @@ def discover_tokens_tool(
     block_range: int = DEFAULT_BLOCK_RANGE,
     liquidity_threshold: float = DEFAULT_LIQUIDITY_THRESHOLD,
     deployment_threshold: int = DEFAULT_DEPLOYMENT_THRESHOLD,
+    index_path: Optional[str] = None,
+    index_only: bool = False,
+    max_reserves_age: int = DEFAULT_MAX_RESERVES_AGE,
 ):
     """
     Searches for newly deployed ERC-20 tokens.
@@ -271,6 +399,9 @@ def discover_tokens_tool(
     block_range: the number of blocks to parse for newly deployed pools
     liquidity_threshold: the min liquidity (in dollars) of a pool to be considered liquid enough
     deployment_threshold: the max age (in hours) of a token since its deployment for it to be considered
+    index_path: a local pool index file, so only blocks that were not indexed yet are scanned
+    index_only: query the index as it is, without updating it from the chain
+    max_reserves_age: the max age (in blocks) of the reserves in the index before they are read again
     """
 
     if rpc is None or rpc == "...":
@@ -279,25 +410,52 @@ def discover_tokens_tool(
     if twitter_credentials is None or twitter_credentials == "...":
         twitter_credentials = os.getenv("TWITTER_CREDENTIALS", None)
 
+    if index_path is None or index_path == "...":
+        index_path = os.getenv("POOL_INDEX_PATH", None)
+
     block_range = int(block_range)
     liquidity_threshold = int(liquidity_threshold)
     deployment_threshold = int(deployment_threshold)
+    index_only = str(index_only).lower() == "true"
+    max_reserves_age = int(max_reserves_age)
+
+    from web3 import Web3
+
+    from packages.dvilela.customs.token_discovery_tool.pool_index import PoolIndex
 
     # Get tokens
     web3 = Web3(Web3.HTTPProvider(rpc))
-    new_tokens = find_new_tokens(
-        web3, block_range, liquidity_threshold, deployment_threshold
-    )
+    index = None
+
+    if index_path:
+        index = PoolIndex(index_path)
+        latest_block = (
+            index.latest_block()
+            if index_only
+            else update_pool_index(web3, index, block_range, max_reserves_age)
+        )
+        if latest_block is None:
+            print("The index is empty")
+            return []
+
+        from_block = latest_block - block_range
+        eth_price = (
+            get_eth_price() if index.has_weth_pools(from_block) else float("nan")
+        )
+        new_tokens = index.query(
+            from_block, liquidity_threshold, deployment_threshold, eth_price
+        )
+        print(f"Found {len(new_tokens)} new tokens with enough liquidity in the index")
+    else:
+        new_tokens = find_new_tokens(
+            web3, block_range, liquidity_threshold, deployment_threshold
+        )
 
     # Check popularity on Twitter
     if new_tokens and twitter_credentials:
         print("Checking popularity on Twitter")
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(twikit_login(twitter_credentials))
-
-        for token in new_tokens:
-            token["is_popular"] = loop.run_until_complete(is_popular(token["symbol"]))
-            print(f"Is {token['symbol']} popular? {token['is_popular']}")
+        # Runs on its own loop, as the tool can be called from worker threads
+        asyncio.run(check_popularity(new_tokens, twitter_credentials, index))
 
     return new_tokens
 
@@ -311,7 +469,9 @@ def run(**kwargs) -> Tuple[Optional[str], Optional[Dict[str, Any]], Any, Any]:
         .get("RPCS", {})
         .get("base", os.environ.get("RPC_BASE"))
     )
-    if not rpc:
+    # The index can be queried without connecting to the chain
+    index_only = kwargs.get("index_only", False)
+    if not rpc and str(index_only).lower() != "true":
         return error_response("RPC was not provided")
 
     # Twitter credentials
@@ -323,8 +483,18 @@ def run(**kwargs) -> Tuple[Optional[str], Optional[Dict[str, Any]], Any, Any]:
         "deployment_threshold", DEFAULT_DEPLOYMENT_THRESHOLD
     )
 
+    index_path = kwargs.get("index_path", None)
+    max_reserves_age = kwargs.get("max_reserves_age", DEFAULT_MAX_RESERVES_AGE)
+
     new_tokens = discover_tokens_tool(
-        rpc, twitter_credentials, block_range, liquidity_threshold, deployment_threshold
+        rpc,
+        twitter_credentials,
+        block_range,
+        liquidity_threshold,
+        deployment_threshold,
+        index_path,
+        index_only,
+        max_reserves_age,
     )
 
     return new_tokens, None, None, None